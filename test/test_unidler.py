@@ -1,7 +1,12 @@
+import copy
 from io import BytesIO
 from http import HTTPStatus
+from http.client import HTTPResponse
+from types import SimpleNamespace
 from unittest.mock import MagicMock, call, patch
 
+import kubernetes
+from kubernetes.client.rest import ApiException
 import pytest
 
 import unidler
@@ -19,75 +24,116 @@ from unidler import (
 HOSTNAME = 'test.host.name'
 
 
+def unidle_patch(replicas):
+    return {
+        'metadata': {
+            'labels': {IDLED: None},
+            'annotations': {IDLED_AT: None},
+        },
+        'spec': {
+            'replicas': replicas,
+        },
+    }
+
+
 @pytest.yield_fixture
 def client():
     client = MagicMock()
-    with patch('unidler.client', client):
+    client.ExtensionsV1beta1Api.return_value = MagicMock(
+        spec=kubernetes.client.ExtensionsV1beta1Api)
+    client.AppsV1beta1Api.return_value = MagicMock(
+        spec=kubernetes.client.AppsV1beta1Api)
+    with patch('unidler.client', client), \
+            patch('unidler.extensions_api',
+                  client.ExtensionsV1beta1Api.return_value), \
+            patch('unidler.apps_api', client.AppsV1beta1Api.return_value), \
+            patch.dict('unidler.ingresses', clear=True), \
+            patch.dict('unidler.ingress_hosts', clear=True), \
+            patch.dict('unidler.deployments', clear=True), \
+            patch.dict('unidler.unidling', clear=True), \
+            patch.dict('unidler.ready_hosts', clear=True), \
+            patch.dict('unidler.unidling_locks', clear=True):
         yield client
 
 
 @pytest.fixture
 def deployment():
-    deployment = MagicMock()
-    deployment.spec.replicas = 0
-    deployment.metadata.labels = {
-        IDLED: 'true',
-    }
-    deployment.metadata.annotations = {
-        IDLED_AT: 'YYYY-mm-ddTHH:MM:SS+0000,2',
-    }
-    deployment.metadata.name = 'test-app'
-    deployment.metadata.namespace = 'test-namespace'
-    deployment.status.available_replicas = 0
-    return deployment
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            name='test-app',
+            namespace='test-namespace',
+            generation=1,
+            labels={
+                IDLED: 'true',
+            },
+            annotations={
+                IDLED_AT: 'YYYY-mm-ddTHH:MM:SS+0000,2',
+            },
+        ),
+        spec=SimpleNamespace(
+            replicas=0,
+        ),
+        status=SimpleNamespace(
+            available_replicas=0,
+        ),
+    )
 
 
 @pytest.fixture
 def ingress():
-    host_rule = MagicMock()
-    host_rule.host = HOSTNAME
-    ingress = MagicMock()
-    ingress.spec.rules = [
-        host_rule,
-    ]
-    ingress.metadata.annotations = {
-        INGRESS_CLASS: 'disabled',
-    }
-    ingress.metadata.name = 'test-app'
-    ingress.metadata.namespace = 'test-namespace'
-    return ingress
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            name='test-app',
+            namespace='test-namespace',
+            annotations={
+                INGRESS_CLASS: 'disabled',
+            },
+        ),
+        spec=SimpleNamespace(
+            rules=[
+                SimpleNamespace(host=HOSTNAME),
+            ],
+            tls=None,
+        ),
+    )
 
 
 @pytest.fixture
 def unidler_ingress(client):
+    ingress = SimpleNamespace(
+        metadata=SimpleNamespace(
+            name=UNIDLER,
+            namespace=UNIDLER_NAMESPACE,
+            annotations={},
+        ),
+        spec=SimpleNamespace(
+            rules=[
+                SimpleNamespace(host=HOSTNAME),
+            ],
+            tls=None,
+        ),
+    )
     api = client.ExtensionsV1beta1Api.return_value
-    ingress = api.read_namespaced_ingress.return_value
-    host_rule = MagicMock()
-    host_rule.host = HOSTNAME
-    ingress.spec.rules = [
-        host_rule,
-    ]
-    ingress.metadata.name = UNIDLER
-    ingress.metadata.namespace = UNIDLER_NAMESPACE
+    api.read_namespaced_ingress.return_value = ingress
     return ingress
 
 
 def test_remove_host_rule(unidler_ingress):
     assert any(rule.host == HOSTNAME for rule in unidler_ingress.spec.rules)
 
-    unidler.remove_host_rule(HOSTNAME, unidler_ingress)
+    assert unidler.remove_host_rule(HOSTNAME, unidler_ingress) == 1
 
     assert all(rule.host != HOSTNAME for rule in unidler_ingress.spec.rules)
+    assert unidler.remove_host_rule(HOSTNAME, unidler_ingress) == 0
 
 
-def test_unmark_idled(deployment):
-    assert IDLED in deployment.metadata.labels
-    assert IDLED_AT in deployment.metadata.annotations
+def test_remove_host_rule_tls(unidler_ingress):
+    tls = SimpleNamespace(hosts=[HOSTNAME, 'other.host.name'])
+    unidler_ingress.spec.tls = [tls]
 
-    unidler.unmark_idled(deployment)
+    assert unidler.remove_host_rule(HOSTNAME, unidler_ingress) == 2
 
-    assert IDLED not in deployment.metadata.labels
-    assert IDLED_AT not in deployment.metadata.annotations
+    assert tls.hosts == ['other.host.name']
 
 
 def test_enable_ingress(ingress):
@@ -98,23 +144,52 @@ def test_enable_ingress(ingress):
     assert ingress.metadata.annotations[INGRESS_CLASS] == 'istio'
 
 
-def test_restore_replicas(deployment):
-    assert deployment.spec.replicas == 0
-    assert deployment.metadata.annotations[IDLED_AT].split(',')[1] == '2'
+def test_enable_ingress_removes_idled_at(ingress):
+    ingress.metadata.annotations[IDLED_AT] = 'YYYY-mm-ddTHH:MM:SS+0000,2'
+
+    unidler.enable_ingress(ingress)
+
+    assert IDLED_AT not in ingress.metadata.annotations
+
 
-    unidler.restore_replicas(deployment)
+def test_idled_replicas(deployment):
+    annotation = deployment.metadata.annotations[IDLED_AT]
 
-    assert deployment.spec.replicas == 2
+    assert unidler.idled_replicas(annotation) == 2
+    assert unidler.idled_replicas(None) == 1
 
 
 def test_write_deployment_changes(client, deployment):
-    unidler.write_deployment_changes(deployment)
+    unidler.write_deployment_changes(
+        deployment.metadata.name,
+        deployment.metadata.namespace,
+        2)
 
     api = client.AppsV1beta1Api.return_value
-    api.replace_namespaced_deployment.assert_called_with(
+    api.patch_namespaced_deployment.assert_called_with(
         deployment.metadata.name,
         deployment.metadata.namespace,
-        deployment)
+        unidle_patch(2))
+
+
+def test_write_deployment_changes_not_found(client, deployment):
+    api = client.AppsV1beta1Api.return_value
+    api.patch_namespaced_deployment.side_effect = ApiException(
+        status=HTTPStatus.NOT_FOUND)
+
+    with pytest.raises(unidler.DeploymentNotFound):
+        unidler.write_deployment_changes(
+            deployment.metadata.name,
+            deployment.metadata.namespace,
+            2)
+
+
+def test_is_idle_from_ingress(client, ingress):
+    ingress.metadata.annotations[IDLED_AT] = 'YYYY-mm-ddTHH:MM:SS+0000,2'
+    unidler.cache_ingress(ingress)
+
+    assert unidler.is_idle(HOSTNAME)
+    assert client.AppsV1beta1Api.return_value.mock_calls == []
 
 
 def test_deployment_for_ingress(client, deployment, ingress):
@@ -127,6 +202,34 @@ def test_deployment_for_ingress(client, deployment, ingress):
         ingress.metadata.namespace)
 
 
+def test_deployment_for_ingress_cached(client, deployment, ingress):
+    api = client.AppsV1beta1Api.return_value
+    api.list_namespaced_deployment.return_value.items = [deployment]
+
+    assert unidler.deployment_for_ingress(ingress, cached=True) is deployment
+    api.list_namespaced_deployment.assert_called_with(
+        ingress.metadata.namespace,
+        field_selector=f'metadata.name={ingress.metadata.name}',
+        resource_version='0')
+    api.read_namespaced_deployment.assert_not_called()
+
+
+def test_deployment_for_ingress_watched(client, deployment, ingress):
+    unidler.cache_deployment(deployment)
+    api = client.AppsV1beta1Api.return_value
+
+    assert unidler.deployment_for_ingress(ingress, cached=True) is deployment
+    assert api.mock_calls == []
+
+
+def test_deployment_for_ingress_cached_not_found(client, ingress):
+    api = client.AppsV1beta1Api.return_value
+    api.list_namespaced_deployment.return_value.items = []
+
+    with pytest.raises(unidler.DeploymentNotFound):
+        unidler.deployment_for_ingress(ingress, cached=True)
+
+
 def test_write_ingress_changes(client, ingress):
     api = client.ExtensionsV1beta1Api.return_value
 
@@ -135,7 +238,26 @@ def test_write_ingress_changes(client, ingress):
     api.patch_namespaced_ingress.assert_called_with(
         ingress.metadata.name,
         ingress.metadata.namespace,
-        ingress)
+        {
+            'metadata': {
+                'annotations': {
+                    IDLED_AT: None,
+                    INGRESS_CLASS: 'disabled',
+                },
+            },
+            'spec': {
+                'rules': ingress.spec.rules,
+                'tls': ingress.spec.tls,
+            },
+        })
+
+
+def test_deployment_for_ingress_forbidden(client, ingress):
+    api = client.AppsV1beta1Api.return_value
+    api.list_namespaced_deployment.side_effect = ApiException(status=403)
+
+    with pytest.raises(ApiException):
+        unidler.deployment_for_ingress(ingress, cached=True)
 
 
 def test_ingress_for_host(client, ingress, unidler_ingress):
@@ -148,11 +270,215 @@ def test_ingress_for_host(client, ingress, unidler_ingress):
     ing = unidler.ingress_for_host(HOSTNAME)
     assert ing.metadata.name == ingress.metadata.name
     assert ing.metadata.namespace == ingress.metadata.namespace
+    api.list_ingress_for_all_namespaces.assert_called_with(
+        resource_version='0')
+
+
+def test_ingress_for_host_cached(client, ingress):
+    unidler.cache_ingress(ingress)
+
+    ing = unidler.ingress_for_host(HOSTNAME)
+
+    assert ing.metadata.name == ingress.metadata.name
+    assert ing is not ingress
+    api = client.ExtensionsV1beta1Api.return_value
+    assert api.mock_calls == []
+
+
+def test_ingress_for_host_cache_miss(client, ingress, unidler_ingress):
+    api = client.ExtensionsV1beta1Api.return_value
+    api.list_ingress_for_all_namespaces.return_value.items = [
+        unidler_ingress,
+        ingress,
+    ]
+
+    ing = unidler.ingress_for_host(HOSTNAME)
+
+    assert unidler.ingress_hosts[HOSTNAME] == (
+        ingress.metadata.name,
+        ingress.metadata.namespace)
+    assert ing is not unidler.ingresses[unidler.object_key(ingress)]
+
+
+def test_ingress_for_host_after_sync(client):
+    with patch.object(unidler, 'ingresses_synced') as synced:
+        synced.is_set.return_value = True
+        with pytest.raises(unidler.IngressNotFound):
+            unidler.ingress_for_host('unknown.host.name')
+
+    api = client.ExtensionsV1beta1Api.return_value
+    api.list_ingress_for_all_namespaces.assert_not_called()
+
+
+def test_cache_ingress(client, ingress, unidler_ingress):
+    unidler.cache_ingress(unidler_ingress)
+    assert HOSTNAME not in unidler.ingress_hosts
+    assert unidler.ingresses[(UNIDLER, UNIDLER_NAMESPACE)] is unidler_ingress
+
+    unidler.cache_ingress(ingress)
+    assert unidler.ingress_hosts[HOSTNAME] == (
+        ingress.metadata.name,
+        ingress.metadata.namespace)
+
+    unidler.uncache_ingress(unidler.object_key(ingress))
+    assert HOSTNAME not in unidler.ingress_hosts
+
+
+def test_cache_ingress_changed_hosts(client, ingress):
+    unidler.cache_ingress(ingress)
+    changed = copy.deepcopy(ingress)
+    changed.spec.rules = [SimpleNamespace(host='other.host.name')]
+
+    unidler.cache_ingress(changed)
+
+    assert HOSTNAME not in unidler.ingress_hosts
+    assert unidler.ingress_hosts['other.host.name'] == (
+        ingress.metadata.name,
+        ingress.metadata.namespace)
+    assert unidler.ingresses[unidler.object_key(ingress)] is changed
+
+
+def test_cache_ingress_all_hosts(client, ingress):
+    ingress.spec.rules.append(SimpleNamespace(host='other.host.name'))
+
+    unidler.cache_ingress(ingress)
+
+    assert unidler.ingress_hosts[HOSTNAME] == unidler.object_key(ingress)
+    assert unidler.ingress_hosts['other.host.name'] == (
+        unidler.object_key(ingress))
+
+
+def test_cache_ingress_host_changed(client, ingress):
+    unidler.cache_ingress(ingress)
+    changed = copy.deepcopy(ingress)
+    changed.spec.rules = [SimpleNamespace(host='other.host.name')]
+
+    unidler.cache_ingress(changed)
+
+    assert HOSTNAME not in unidler.ingress_hosts
+    assert 'other.host.name' in unidler.ingress_hosts
+
+
+def test_keep_cached_streams_from_synced_version(client):
+    class Stop(BaseException):
+        pass
+
+    resource_versions = []
+    with patch('unidler.watch.Watch') as Watch, \
+            patch('unidler.sync_cache', return_value='500'):
+        watcher = Watch.return_value
+        watcher.resource_version = '100'
+
+        def stream(*args, **kwargs):
+            resource_versions.append(watcher.resource_version)
+            raise Stop()
+
+        watcher.stream.side_effect = stream
+        with pytest.raises(Stop):
+            unidler.keep_cached(
+                'Ingress',
+                MagicMock(),
+                unidler.ingresses,
+                unidler.cache_ingress,
+                unidler.uncache_ingress)
+
+    assert resource_versions == ['500']
+
+
+def test_keep_cached_continues_after_timeout(client):
+    class Stop(BaseException):
+        pass
+
+    with patch('unidler.watch.Watch') as Watch, \
+            patch('unidler.sync_cache', return_value='500') as sync_cache:
+        watcher = Watch.return_value
+        streams = [[], Stop()]
+
+        def stream(*args, **kwargs):
+            watcher.resource_version = '600'
+            result = streams.pop(0)
+            if isinstance(result, Stop):
+                raise result
+            return result
+
+        watcher.stream.side_effect = stream
+        with pytest.raises(Stop):
+            unidler.keep_cached(
+                'Ingress',
+                MagicMock(),
+                unidler.ingresses,
+                unidler.cache_ingress,
+                unidler.uncache_ingress)
+
+    sync_cache.assert_called_once()
+    first, second = watcher.stream.call_args_list
+    assert first[1]['resource_version'] == '500'
+    assert first[1]['timeout_seconds'] == unidler.WATCH_TIMEOUT_SECONDS
+    assert second[1]['resource_version'] == '600'
+
+
+def test_sync_cache(client, ingress):
+    unidler.cache_ingress(ingress)
+    list_all = MagicMock()
+    list_all.return_value.items = []
+    list_all.return_value.metadata.resource_version = '123'
+    list_all.return_value.metadata._continue = None
+
+    resource_version = unidler.sync_cache(
+        list_all,
+        unidler.ingresses,
+        unidler.cache_ingress,
+        unidler.uncache_ingress)
+
+    assert resource_version == '123'
+    list_all.assert_called_with(limit=unidler.LIST_PAGE_SIZE)
+    assert unidler.ingresses == {}
+    assert HOSTNAME not in unidler.ingress_hosts
+
+
+def test_sync_cache_pages(client, ingress, unidler_ingress):
+    first = MagicMock(items=[ingress])
+    first.metadata._continue = 'next-page'
+    second = MagicMock(items=[unidler_ingress])
+    second.metadata._continue = None
+    second.metadata.resource_version = '123'
+    list_all = MagicMock(side_effect=[first, second])
+
+    resource_version = unidler.sync_cache(
+        list_all,
+        unidler.ingresses,
+        unidler.cache_ingress,
+        unidler.uncache_ingress)
+
+    assert resource_version == '123'
+    list_all.assert_has_calls([
+        call(limit=unidler.LIST_PAGE_SIZE),
+        call(limit=unidler.LIST_PAGE_SIZE, _continue='next-page'),
+    ])
+    assert set(unidler.ingresses) == {
+        unidler.object_key(ingress),
+        unidler.object_key(unidler_ingress),
+    }
+
+
+def test_unidler_ingress_not_cached(client, unidler_ingress):
+    # the idler may have added rules the watch hasn't seen yet
+    stale = copy.deepcopy(unidler_ingress)
+    stale.spec.rules = []
+    unidler.cache_ingress(stale)
+
+    ingress = unidler.unidler_ingress()
+
+    assert ingress is unidler_ingress
+    api = client.ExtensionsV1beta1Api.return_value
+    api.read_namespaced_ingress.assert_called_once_with(
+        UNIDLER, UNIDLER_NAMESPACE)
 
 
 def test_unidling_start(client, deployment, ingress):
     apps = client.AppsV1beta1Api.return_value
     apps.read_namespaced_deployment.return_value = deployment
+    apps.list_namespaced_deployment.return_value.items = [deployment]
     extensions = client.ExtensionsV1beta1Api.return_value
     extensions.list_ingress_for_all_namespaces.return_value.items = [
         ingress
@@ -161,13 +487,207 @@ def test_unidling_start(client, deployment, ingress):
     unidling = Unidling(HOSTNAME)
     unidling.start()
 
-    apps.replace_namespaced_deployment.assert_called_with(
+    apps.patch_namespaced_deployment.assert_called_once_with(
         deployment.metadata.name,
         deployment.metadata.namespace,
-        deployment)
-    assert IDLED not in deployment.metadata.labels
-    assert IDLED_AT not in deployment.metadata.annotations
-    assert deployment.spec.replicas == 2
+        unidle_patch(2))
+
+
+def test_unidling_lock():
+    lock = unidler.unidling_lock(HOSTNAME)
+
+    assert unidler.unidling_lock(HOSTNAME) is lock
+    assert unidler.unidling_lock('other.host.name') is not lock
+
+
+def test_unidling_start_from_ingress(client, ingress):
+    ingress.metadata.annotations[IDLED_AT] = 'YYYY-mm-ddTHH:MM:SS+0000,3'
+    unidler.cache_ingress(ingress)
+    apps = client.AppsV1beta1Api.return_value
+
+    unidling = Unidling(HOSTNAME)
+    unidling.start()
+
+    apps.read_namespaced_deployment.assert_not_called()
+    apps.patch_namespaced_deployment.assert_called_with(
+        ingress.metadata.name,
+        ingress.metadata.namespace,
+        unidle_patch(3))
+
+
+def test_unidling_start_stale_deployment(client, deployment, ingress):
+    # the watch hasn't seen the deployment being idled yet
+    ingress.metadata.annotations[IDLED_AT] = 'YYYY-mm-ddTHH:MM:SS+0000,3'
+    unidler.cache_ingress(ingress)
+    deployment.metadata.labels = {}
+    unidler.cache_deployment(deployment)
+    apps = client.AppsV1beta1Api.return_value
+
+    unidling = Unidling(HOSTNAME)
+    unidling.start()
+
+    apps.patch_namespaced_deployment.assert_called_once_with(
+        ingress.metadata.name,
+        ingress.metadata.namespace,
+        unidle_patch(3))
+
+
+def test_finish_unidling(client, deployment, ingress):
+    deployment.metadata.labels = {}
+    deployment.status.available_replicas = 1
+    unidler.cache_deployment(deployment)
+    unidling = Unidling(HOSTNAME)
+    unidling.started = True
+    unidling.ingress = ingress
+    unidling.enable_ingress = MagicMock()
+    unidler.unidling[HOSTNAME] = unidling
+
+    unidler.finish_unidling(HOSTNAME)
+
+    unidling.enable_ingress.assert_called_once()
+    assert HOSTNAME not in unidler.unidling
+
+
+def test_unidling_is_done_stale_cache(client, deployment, ingress):
+    # the watch hasn't yet seen our write or the idling before it
+    deployment.metadata.labels = {}
+    deployment.metadata.generation = 3
+    deployment.status.available_replicas = 1
+    unidler.cache_deployment(deployment)
+    fresh = copy.deepcopy(deployment)
+    fresh.metadata.generation = 5
+    fresh.status.available_replicas = 0
+    api = client.AppsV1beta1Api.return_value
+    api.read_namespaced_deployment.return_value = fresh
+    unidling = Unidling(HOSTNAME)
+    unidling.started = True
+    unidling.ingress = ingress
+    unidling.generation = 5
+
+    assert not unidling.is_done()
+    api.read_namespaced_deployment.assert_called_once_with(
+        ingress.metadata.name, ingress.metadata.namespace)
+
+
+def test_finish_unidling_expired(client, deployment, ingress):
+    unidler.cache_deployment(deployment)
+    unidling = Unidling(HOSTNAME)
+    unidling.started = True
+    unidling.ingress = ingress
+    unidling.started_at -= unidler.UNIDLING_TIMEOUT_SECONDS + 1
+    unidler.unidling[HOSTNAME] = unidling
+
+    unidler.finish_unidling(HOSTNAME)
+
+    assert HOSTNAME not in unidler.unidling
+
+
+def test_finish_unidling_repeated_failures(client, ingress):
+    api = client.AppsV1beta1Api.return_value
+    api.read_namespaced_deployment.side_effect = ApiException(status=404)
+    unidling = Unidling(HOSTNAME)
+    unidling.started = True
+    unidling.ingress = ingress
+    unidler.unidling[HOSTNAME] = unidling
+
+    for _ in range(unidler.UNIDLING_MAX_FAILURES):
+        assert HOSTNAME in unidler.unidling
+        with pytest.raises(unidler.DeploymentNotFound):
+            unidler.finish_unidling(HOSTNAME)
+
+    assert HOSTNAME not in unidler.unidling
+
+
+def test_finish_unidling_failures_reset(client, deployment, ingress):
+    unidler.cache_deployment(deployment)
+    unidling = Unidling(HOSTNAME)
+    unidling.started = True
+    unidling.ingress = ingress
+    unidling.failures = unidler.UNIDLING_MAX_FAILURES - 1
+    unidler.unidling[HOSTNAME] = unidling
+
+    unidler.finish_unidling(HOSTNAME)
+
+    assert unidling.failures == 0
+    assert HOSTNAME in unidler.unidling
+
+
+def test_is_ready():
+    assert not unidler.is_ready(HOSTNAME)
+
+    unidler.mark_ready(HOSTNAME)
+    assert unidler.is_ready(HOSTNAME)
+
+    unidler.ready_hosts[HOSTNAME] = 0
+    assert not unidler.is_ready(HOSTNAME)
+    assert HOSTNAME not in unidler.ready_hosts
+
+
+def test_unidling_enable_ingress_no_unidler_rule(
+        client, ingress, unidler_ingress):
+    unidler_ingress.spec.rules = []
+    unidling = Unidling(HOSTNAME)
+    unidling.ingress = ingress
+
+    unidling.enable_ingress()
+
+    api = client.ExtensionsV1beta1Api.return_value
+    api.patch_namespaced_ingress.assert_called_once_with(
+        ingress.metadata.name,
+        ingress.metadata.namespace,
+        unidler.ingress_changes(ingress))
+
+
+def test_unidling_enable_ingress_retried_after_failure(
+        client, ingress, unidler_ingress):
+    api = client.ExtensionsV1beta1Api.return_value
+    # the unidler rule was removed but enabling the app ingress failed
+    failures = [ApiException(status=500)]
+
+    def patch_ingress(name, namespace, body):
+        if name == ingress.metadata.name and failures:
+            raise failures.pop()
+        return MagicMock()
+
+    api.patch_namespaced_ingress.side_effect = patch_ingress
+    api.read_namespaced_ingress.side_effect = (
+        lambda name, namespace: copy.deepcopy(unidler_ingress))
+    unidling = Unidling(HOSTNAME)
+    unidling.ingress = ingress
+
+    with pytest.raises(ApiException):
+        unidling.enable_ingress()
+    assert not unidling.enabled
+
+    unidling.enable_ingress()
+    assert unidling.enabled
+    assert api.patch_namespaced_ingress.call_count == 4
+
+
+def test_please_wait():
+    body = unidler.please_wait(HOSTNAME)
+
+    assert f"UNIDLER_REDIRECT_URL = 'https://{HOSTNAME}'".encode() in body
+    assert b"UNIDLER_REDIRECT_URL = ''" not in body
+
+
+def test_server_uses_thread_pool():
+    server = unidler.UnidlerServer(('127.0.0.1', 0), RequestHandler)
+    request = MagicMock()
+    try:
+        with patch.object(server, 'finish_request') as finish_request, \
+                patch.object(server, 'shutdown_request') as shutdown_request:
+            server.process_request(request, ('127.0.0.1', 8888))
+            server.requests.join()
+
+        finish_request.assert_called_with(request, ('127.0.0.1', 8888))
+        shutdown_request.assert_called_with(request)
+    finally:
+        server.server_close()
+
+    for thread in server.threads:
+        thread.join(timeout=1)
+        assert not thread.is_alive()
 
 
 class TestRequestHandler(object):
@@ -183,14 +703,45 @@ class TestRequestHandler(object):
         ]
 
         apps.read_namespaced_deployment.return_value = deployment
+        apps.list_namespaced_deployment.return_value.items = [deployment]
+
+        response = self.handle_request('GET', '/', {
+            'Host': HOSTNAME,
+        })
+        assert response.status_code == HTTPStatus.ACCEPTED
+        assert response.headers['Content-type'] == 'text/html'
+        assert f"'https://{HOSTNAME}'" in response.body
+        assert int(response.headers['Content-Length']) == len(
+            response.body.encode('utf-8'))
+        assert 'Date' in response.headers
+        apps.patch_namespaced_deployment.assert_called_once_with(
+            deployment.metadata.name,
+            deployment.metadata.namespace,
+            unidle_patch(2))
+
+    def test_doGET_start_failed(self, client, deployment, ingress):
+        unidler.cache_ingress(ingress)
+        unidler.cache_deployment(deployment)
+        apps = client.AppsV1beta1Api.return_value
+        apps.patch_namespaced_deployment.side_effect = [
+            ApiException(status=500),
+            deployment,
+        ]
+
+        response = self.handle_request('GET', '/', {
+            'Host': HOSTNAME,
+        })
+
+        assert response.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+        assert HOSTNAME not in unidler.unidling
 
         response = self.handle_request('GET', '/', {
             'Host': HOSTNAME,
         })
+
         assert response.status_code == HTTPStatus.ACCEPTED
-        assert IDLED not in deployment.metadata.labels
-        assert IDLED_AT not in deployment.metadata.annotations
-        assert deployment.spec.replicas == 2
+        assert HOSTNAME in unidler.unidling
+        assert apps.patch_namespaced_deployment.call_count == 2
 
     def test_doGET_already_started(self, client, deployment, ingress):
 
@@ -205,14 +756,14 @@ class TestRequestHandler(object):
         unidling = Unidling(HOSTNAME)
         unidling.started = True
         unidling.ingress = ingress
-        RequestHandler.unidling[HOSTNAME] = unidling
+        unidler.unidling[HOSTNAME] = unidling
 
         response = self.handle_request('GET', '/', {
             'Host': HOSTNAME,
         })
 
         api = client.AppsV1beta1Api.return_value
-        api.replace_namespaced_deployment.assert_not_called()
+        api.patch_namespaced_deployment.assert_not_called()
 
     def test_doGET_unidling_is_done(
             self, client, deployment, ingress, unidler_ingress):
@@ -233,7 +784,7 @@ class TestRequestHandler(object):
         unidling = Unidling(HOSTNAME)
         unidling.started = True
         unidling.ingress = ingress
-        RequestHandler.unidling[HOSTNAME] = unidling
+        unidler.unidling[HOSTNAME] = unidling
 
         response = self.handle_request('GET', '/', {
             'Host': HOSTNAME,
@@ -245,7 +796,96 @@ class TestRequestHandler(object):
 
         assert ingress.metadata.annotations[INGRESS_CLASS] == 'istio'
 
-        assert HOSTNAME not in RequestHandler.unidling
+        ext.patch_namespaced_ingress.assert_has_calls([
+            call(
+                UNIDLER,
+                UNIDLER_NAMESPACE,
+                unidler.ingress_changes(unidler_ingress)),
+            call(
+                ingress.metadata.name,
+                ingress.metadata.namespace,
+                unidler.ingress_changes(ingress)),
+        ], any_order=True)
+
+        assert HOSTNAME not in unidler.unidling
+        assert unidler.is_ready(HOSTNAME)
+
+    def test_doGET_in_progress_elsewhere(self, client, ingress):
+        unidler.cache_ingress(ingress)
+        with unidler.unidling_lock(HOSTNAME):
+            response = self.handle_request('GET', '/', {
+                'Host': HOSTNAME,
+            })
+
+        assert response.status_code == HTTPStatus.ACCEPTED
+        assert client.ExtensionsV1beta1Api.return_value.mock_calls == []
+        assert client.AppsV1beta1Api.return_value.mock_calls == []
+        assert not unidler.unidling_lock(HOSTNAME).locked()
+
+    def test_doGET_unknown_host(self, client):
+        with patch.object(unidler, 'ingresses_synced') as synced:
+            synced.is_set.return_value = True
+            response = self.handle_request('GET', '/', {
+                'Host': 'unknown.host.name',
+            })
+
+        assert response.status_code == HTTPStatus.NOT_FOUND
+        assert unidler.unidling_locks == {}
+
+    def test_doGET_unidler_host(self, client):
+        response = self.handle_request('GET', '/', {
+            'Host': f'{UNIDLER}:8080',
+        })
+
+        assert response.status_code == HTTPStatus.NO_CONTENT
+        assert client.ExtensionsV1beta1Api.return_value.mock_calls == []
+
+    def test_doGET_recently_ready(self, client):
+        unidler.mark_ready(HOSTNAME)
+
+        response = self.handle_request('GET', '/', {
+            'Host': HOSTNAME,
+        })
+
+        assert response.status_code == HTTPStatus.ACCEPTED
+        assert client.ExtensionsV1beta1Api.return_value.mock_calls == []
+        assert client.AppsV1beta1Api.return_value.mock_calls == []
+
+    def test_doHEAD(self, client):
+        response = self.handle_request('HEAD', '/', {
+            'Host': HOSTNAME,
+        })
+
+        assert response.status_code == HTTPStatus.OK
+        assert client.ExtensionsV1beta1Api.return_value.mock_calls == []
+        assert client.AppsV1beta1Api.return_value.mock_calls == []
+        assert HOSTNAME not in unidler.unidling
+
+    def test_doPOST(self, client):
+        response = self.handle_request('POST', '/', {
+            'Host': HOSTNAME,
+        })
+
+        assert response.status_code == HTTPStatus.METHOD_NOT_ALLOWED
+        assert client.ExtensionsV1beta1Api.return_value.mock_calls == []
+        assert client.AppsV1beta1Api.return_value.mock_calls == []
+
+    def test_no_keep_alive(self, client):
+        # an idle kept alive connection would hold one of the server's
+        # fixed pool of threads
+        unidler.mark_ready(HOSTNAME)
+        request = (
+            f'GET / HTTP/1.1\nHost: {HOSTNAME}\n\n'
+            f'GET / HTTP/1.1\nHost: {HOSTNAME}\n\n'
+        )
+        mock = MagicMock()
+        mock.makefile.return_value = BytesIO(request.encode('iso-8859-1'))
+        with patch('socketserver._SocketWriter') as SocketWriter:
+            writer = SocketWriter.return_value
+            RequestHandler(mock, ('0.0.0.0', 8888), MagicMock())
+
+        response, = writer.write.mock_calls
+        assert response[1][0].startswith(b'HTTP/1.0 202')
 
     def handle_request(self, method, path, headers={}):
         request = f'{method} {path} HTTP/1.0\n'
@@ -260,18 +900,14 @@ class TestRequestHandler(object):
             return self.parse_response(writer.write.mock_calls)
 
     def parse_response(self, calls):
+        sock = MagicMock()
+        sock.makefile.return_value = BytesIO(b''.join(
+            call[1][0]
+            for call in calls))
+        response = HTTPResponse(sock)
+        response.begin()
         res = MagicMock()
-        response = ''.join(
-            call[1][0].decode('utf-8')
-            for call in calls)
-        response = response.split('\r\n')
-        status, response = response[:1][0], response[1:]
-        res.status = status = status.split(' ', 1)[1]
-        res.status_code = int(status.split(' ')[0])
-        res.headers = {}
-        line, response = response[:1][0], response[1:]
-        while line:
-            res.headers.update((line.split(': ', 1),))
-            line, response = response[:1][0], response[1:]
-        res.body = ''.join(response)
+        res.status_code = response.status
+        res.headers = dict(response.getheaders())
+        res.body = response.read().decode('utf-8')
         return res
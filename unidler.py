@@ -1,15 +1,20 @@
-import contextlib
+import copy
+from concurrent.futures import ThreadPoolExecutor, wait
+import functools
 from http import HTTPStatus
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import logging
 import os
+import queue
+from os.path import abspath, dirname, join
 import socket
-from socketserver import ThreadingMixIn
 import ssl
 import sys
+import threading
+import time
 
 import kubernetes
-from kubernetes import client, config
+from kubernetes import client, config, watch
 from kubernetes.client.models import (
     V1beta1HTTPIngressPath,
     V1beta1HTTPIngressRuleValue,
@@ -24,6 +29,61 @@ INGRESS_CLASS = 'kubernetes.io/ingress.class'
 INGRESS_CLASS_NAME = os.environ.get('INGRESS_CLASS_NAME', 'istio')
 UNIDLER = 'unidler'
 UNIDLER_NAMESPACE = 'default'
+WATCH_RETRY_SECONDS = 5
+WATCH_RETRY_MAX_SECONDS = 300
+# the API server ends each watch after this long, and a connection that
+# hears nothing for a while longer is assumed dead, so a half-open one
+# can't leave the caches frozen
+WATCH_TIMEOUT_SECONDS = 300
+WATCH_READ_TIMEOUT_SECONDS = WATCH_TIMEOUT_SECONDS + 60
+LIST_PAGE_SIZE = 500
+UNIDLING_CHECK_SECONDS = 30
+READY_CACHE_SECONDS = 10
+UNIDLING_TIMEOUT_SECONDS = 300
+UNIDLING_MAX_FAILURES = 5
+HTTP_THREADS = int(os.environ.get(
+    'HTTP_THREADS', min(32, 4 * (os.cpu_count() or 1))))
+WRITE_THREADS = 4
+WATCHES = 2
+# enough connections for every thread that can call the API at once, so
+# none queue for one
+CONNECTION_POOL_MAXSIZE = int(os.environ.get(
+    'CONNECTION_POOL_MAXSIZE', HTTP_THREADS + WRITE_THREADS + WATCHES))
+
+# split once around the redirect URL placeholder and encoded, so each
+# response is just a concatenation
+with open(join(dirname(abspath(__file__)), 'please_wait.html'), 'rb') as f:
+    PLEASE_WAIT_HEAD, PLEASE_WAIT_TAIL = f.read().split(
+        b"UNIDLER_REDIRECT_URL = ''", 1)
+
+# (name, namespace) -> ingress, kept up to date by watch_ingresses()
+ingresses = {}
+# hostname -> (name, namespace) of the ingress serving it
+ingress_hosts = {}
+# set once the ingresses have first been listed, after which a host not
+# in ingress_hosts isn't worth listing the cluster for
+ingresses_synced = threading.Event()
+# (name, namespace) -> deployment, kept up to date by watch_deployments()
+deployments = {}
+# held while changing the unidler ingress, which is shared by all hosts
+unidler_ingress_lock = threading.Lock()
+
+# hostname -> Unidling in progress, only changed while holding
+# unidling_lock(hostname)
+unidling = {}
+# hostname -> time until which it is assumed to still be ready
+ready_hosts = {}
+# hostname -> lock, only for hosts with an ingress, so arbitrary Host
+# headers don't each leave a lock behind
+unidling_locks = {}
+unidling_locks_lock = threading.Lock()
+
+write_executor = ThreadPoolExecutor(max_workers=WRITE_THREADS)
+
+# created once in run() and shared by all API calls so they reuse one
+# connection pool
+extensions_api = None
+apps_api = None
 
 logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'DEBUG'))
 app_log = logging.getLogger('unidler')
@@ -36,44 +96,125 @@ def run(host='0.0.0.0', port=8080):
     except:
         config.load_kube_config()
 
+    global extensions_api, apps_api
+    configuration = client.Configuration()
+    configuration.connection_pool_maxsize = CONNECTION_POOL_MAXSIZE
+    api_client = client.ApiClient(configuration)
+    extensions_api = client.ExtensionsV1beta1Api(api_client)
+    apps_api = client.AppsV1beta1Api(api_client)
+
+    threading.Thread(target=watch_ingresses, daemon=True).start()
+    threading.Thread(target=watch_deployments, daemon=True).start()
+    threading.Thread(target=check_unidling, daemon=True).start()
+
     unidler = UnidlerServer((host, int(port)), RequestHandler)
-    app_log.info(f'Unidler listening on {host}:{port}')
+    app_log.info('Unidler listening on %s:%s', host, port)
     unidler.serve_forever()
 
 
-class UnidlerServer(ThreadingMixIn, HTTPServer):
-    pass
+class UnidlerServer(HTTPServer):
+    # handle requests on a fixed pool of threads, rather than starting a
+    # thread for each one like ThreadingMixIn
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = queue.Queue()
+        # daemon threads, like ThreadingMixIn's daemon_threads, so requests
+        # stuck on a slow API call don't hold up shutdown. An executor's
+        # workers are joined at exit
+        self.threads = [
+            threading.Thread(target=self.handle_requests, daemon=True)
+            for _ in range(HTTP_THREADS)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def handle_requests(self):
+        while True:
+            item = self.requests.get()
+            try:
+                if item is None:
+                    return
+                self.process_request_thread(*item)
+            finally:
+                self.requests.task_done()
+
+    def server_close(self):
+        super().server_close()
+        # one for each thread to stop on
+        for _ in self.threads:
+            self.requests.put(None)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
 
 
 class RequestHandler(BaseHTTPRequestHandler):
-    unidling = {}
 
     def do_GET(self):
-        hostname = self.headers.get('Host', UNIDLER)
+        # drop any port, as on in-cluster requests to the service, which
+        # would otherwise miss the check below and be looked up as an app
+        hostname = self.headers.get('Host', UNIDLER).partition(':')[0]
         if hostname.startswith(UNIDLER):
             app_log.debug('No hostname specified')
-            self.respond(HTTPStatus.NO_CONTENT, '')
+            self.respond(HTTPStatus.NO_CONTENT, b'')
             return
 
         username = hostname.split('.')[0]
         log = logging.getLogger('unidler:{}'.format(username))
 
+        if is_ready(hostname):
+            # requests keep arriving until the ingress controller picks up
+            # the enabled ingress, so don't ask the API again
+            log.debug('Recently seen ready, waiting for ingress to switch')
+            self.respond(HTTPStatus.ACCEPTED, please_wait(hostname))
+            return
+
+        # check there is an app for the host before creating its lock
         try:
-            if hostname in self.unidling:
+            ingress_for_host(hostname)
+
+        except IngressNotFound as not_found:
+            self.send_error(HTTPStatus.NOT_FOUND, str(not_found))
+            return
+
+        except Exception as error:
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(error))
+            return
+
+        # only one request per host drives the unidling at a time. Others
+        # arriving meanwhile get the please wait page without repeating
+        # its API calls
+        lock = unidling_lock(hostname)
+        if not lock.acquire(blocking=False):
+            log.debug('Another request is already handling this host')
+            self.respond(HTTPStatus.ACCEPTED, please_wait(hostname))
+            return
+
+        try:
+            if hostname in unidling:
                 log.debug('Internal state: unidling is in progress')
-                if self.unidling[hostname].is_done():
-                    self.unidling[hostname].enable_ingress()
-                    del self.unidling[hostname]
-                else:
-                    log.debug('Unidling is not done yet')
+                finish_unidling(hostname)
 
             elif is_idle(hostname):
                 log.debug('It is idle, so starting unidling')
-                self.unidling[hostname] = Unidling(hostname, log)
-                self.unidling[hostname].start()
+                # only tracked once started, so if starting fails the next
+                # request starts again instead of waiting on it
+                in_progress = Unidling(hostname, log)
+                in_progress.start()
+                unidling[hostname] = in_progress
 
             else:
                 log.error('Shouldn\'t happen - idler received request when it thinks the tool is not idled')
+                mark_ready(hostname)
 
         except (DeploymentNotFound, IngressNotFound) as not_found:
             self.send_error(HTTPStatus.NOT_FOUND, str(not_found))
@@ -84,11 +225,97 @@ class RequestHandler(BaseHTTPRequestHandler):
         else:
             self.respond(HTTPStatus.ACCEPTED, please_wait(hostname))
 
+        finally:
+            lock.release()
+
+    def do_HEAD(self):
+        # health checks and link previews, which shouldn't start unidling
+        self.respond(HTTPStatus.OK, b'')
+
+    def do_POST(self):
+        self.send_error(HTTPStatus.METHOD_NOT_ALLOWED)
+
     def respond(self, status, body):
-        self.send_response(status)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(str(body).encode('utf-8'))
+        self.log_request(status)
+        if not isinstance(body, (bytes, bytearray)):
+            body = str(body).encode('utf-8')
+        # status line, headers and body in a single write. 204 responses
+        # mustn't have a Content-Length
+        length = b''
+        if status != HTTPStatus.NO_CONTENT:
+            length = b'Content-Length: %d\r\n' % len(body)
+        self.wfile.write(b''.join((
+            response_head(self.protocol_version, status),
+            b'Server: %s\r\nDate: %s\r\n' % (
+                self.version_string().encode('latin-1'),
+                self.date_time_string().encode('latin-1')),
+            length,
+            b'\r\n',
+            body,
+        )))
+
+
+def unidling_lock(hostname):
+    with unidling_locks_lock:
+        lock = unidling_locks.get(hostname)
+        if lock is None:
+            lock = unidling_locks[hostname] = threading.Lock()
+        return lock
+
+
+def finish_unidling(hostname):
+    in_progress = unidling[hostname]
+    try:
+        done = in_progress.is_done()
+    except Exception:
+        # e.g. the deployment was deleted, so stop checking on every poll
+        in_progress.failures += 1
+        if in_progress.failures >= UNIDLING_MAX_FAILURES:
+            in_progress.log.error('Giving up unidling after repeated failures')
+            del unidling[hostname]
+        raise
+
+    in_progress.failures = 0
+    if done:
+        in_progress.enable_ingress()
+        del unidling[hostname]
+        mark_ready(hostname)
+    elif in_progress.expired():
+        in_progress.log.error('Giving up unidling, deployment never became ready')
+        del unidling[hostname]
+    else:
+        in_progress.log.debug('Unidling is not done yet')
+
+
+def mark_ready(hostname):
+    ready_hosts[hostname] = time.monotonic() + READY_CACHE_SECONDS
+
+
+def is_ready(hostname):
+    ready_until = ready_hosts.get(hostname)
+    if ready_until is None:
+        return False
+
+    if ready_until < time.monotonic():
+        ready_hosts.pop(hostname, None)
+        return False
+
+    return True
+
+
+def check_unidling():
+    # finish unidlings whose browser has gone away, so their ingress is
+    # still enabled and the Unidling doesn't leak
+    while True:
+        time.sleep(UNIDLING_CHECK_SECONDS)
+        for hostname in list(unidling):
+            try:
+                with unidling_lock(hostname):
+                    if hostname in unidling:
+                        finish_unidling(hostname)
+
+            except Exception as error:
+                app_log.error('Checking unidling of %s failed: %s', hostname, error)
 
 
 class DeploymentNotFound(Exception):
@@ -109,29 +336,51 @@ class Unidling(object):
         self.replicas = 0
         self.enabled = False
         self.log = log
+        self.started_at = time.monotonic()
+        self.failures = 0
+        # of the deployment once our changes were written to it
+        self.generation = None
 
     def start(self):
         if not self.started:
             self.log.debug('Starting unidle')
             self.started = True
             self.ingress = ingress_for_host(self.hostname)
-            self.deployment = deployment_for_ingress(self.ingress)
 
-            restore_replicas(self.deployment, self.log)
-            unmark_idled(self.deployment, self.log)
+            # the idler records the replicas on the ingress too, so the
+            # deployment usually doesn't need reading first
+            annotations = self.ingress.metadata.annotations
+            if IDLED_AT not in annotations:
+                self.deployment = deployment_for_ingress(
+                    self.ingress, cached=True)
+                annotations = self.deployment.metadata.annotations
+            replicas = idled_replicas(annotations.get(IDLED_AT), self.log)
 
             # XXX writing changes triggers the asynchronous creation of
-            # pods, which can take a few seconds
-            write_deployment_changes(self.deployment, self.log)
+            # pods, which can take a few seconds
+            patched = write_deployment_changes(
+                self.ingress.metadata.name,
+                self.ingress.metadata.namespace,
+                replicas,
+                self.log)
+            self.generation = patched.metadata.generation
         else:
             self.log.error('Shouldn\'t happen - starting the idled process for a second time')
 
     def is_done(self):
         if self.started:
-            self.deployment = deployment_for_ingress(self.ingress)
+            # the watch may not have seen our write yet, and a copy from
+            # before it can still show the deployment ready from before it
+            # was idled, so only trust one at least as new as the write
+            self.deployment = deployments.get(object_key(self.ingress))
+            if (self.deployment is None or
+                    (self.deployment.metadata.generation or 0) <
+                    (self.generation or 0)):
+                self.deployment = deployment_for_ingress(self.ingress)
             replicas = int(self.deployment.status.available_replicas or 0)
-            self.log.debug('Is done?\n  "idled" label removed = {}\n  replicas = {}'.format(
-                IDLED not in self.deployment.metadata.labels, replicas))
+            self.log.debug(
+                'Is done?\n  "idled" label removed = %s\n  replicas = %s',
+                IDLED not in self.deployment.metadata.labels, replicas)
             return (
                 IDLED not in self.deployment.metadata.labels and
                 replicas >= 1)
@@ -139,126 +388,364 @@ class Unidling(object):
             self.log.error('Shouldn\'t happen - state is "started" yet unidle appears to be "done"')
         return False
 
+    def expired(self):
+        return time.monotonic() - self.started_at > UNIDLING_TIMEOUT_SECONDS
+
     def enable_ingress(self):
         if not self.enabled:
-            self.enabled = True
             self.log.debug('Enabling ingress')
-            ingress = unidler_ingress()
-            remove_host_rule(self.hostname, ingress, self.log)
-            write_ingress_changes(ingress, self.log)
-            # XXX do we need to wait here for the ingress controller to pick up the
-            # changes?
-            ingress = ingress_for_host(self.hostname)
-            enable_ingress(self.ingress)
-            write_ingress_changes(self.ingress, self.log)
+            # the unidler ingress rules are replaced as a whole, so
+            # concurrent changes to it would undo each other, and it is
+            # read fresh because the idler adds rules to it
+            with unidler_ingress_lock:
+                changed = [self.ingress]
+                ingress = unidler_ingress()
+                # no need to write the unidler ingress if it had no rules
+                # for this host
+                if remove_host_rule(self.hostname, ingress, self.log):
+                    changed.append(ingress)
+                enable_ingress(self.ingress)
+                # the writes are independent, so save a round trip by
+                # making them concurrently
+                writes = [
+                    write_executor.submit(write_ingress_changes, ing, self.log)
+                    for ing in changed
+                ]
+                # let both finish before releasing the lock, even if one
+                # fails, and only count as enabled once both succeeded so
+                # a failed write is retried
+                wait(writes)
+                for write in writes:
+                    write.result()
+            self.enabled = True
         else:
             self.log.error('Shouldn\'t happen - Ingress enabling triggered for the second time')
 
-def deployment_for_ingress(ingress):
+
+def deployment_for_ingress(ingress, cached=False):
+    name = ingress.metadata.name
+    namespace = ingress.metadata.namespace
     try:
-        return client.AppsV1beta1Api().read_namespaced_deployment(
-            ingress.metadata.name,
-            ingress.metadata.namespace)
+        if not cached:
+            return apps_api.read_namespaced_deployment(name, namespace)
+
+        deployment = deployments.get((name, namespace))
+        if deployment is not None:
+            return deployment
+
+        # only lists take a resource version, so list by name to be served
+        # from the API server's watch cache rather than etcd. Callers
+        # checking on their own writes need the uncached read
+        listed = apps_api.list_namespaced_deployment(
+            namespace,
+            field_selector=f'metadata.name={name}',
+            resource_version='0')
 
-    except kubernetes.client.rest.ApiException:
-        raise DeploymentNotFound(
-            ingress.metadata.name,
-            ingress.metadata.namespace)
+    except kubernetes.client.rest.ApiException as error:
+        if error.status == HTTPStatus.NOT_FOUND:
+            raise DeploymentNotFound(name, namespace)
+        raise
+
+    if not listed.items:
+        raise DeploymentNotFound(name, namespace)
+
+    return listed.items[0]
 
 
 def ingress_for_host(hostname):
-    # XXX assumes first ingress rule is the one we want
-    ingresses = client.ExtensionsV1beta1Api().list_ingress_for_all_namespaces()
-    ingress = next(
-        (
-            ingress
-            for ingress in ingresses.items
-            if (ingress.metadata.name != UNIDLER and
-                ingress.spec.rules[0].host == hostname)
-        ),
-        None)
+    ingress = ingresses.get(ingress_hosts.get(hostname))
+    if ingress is not None:
+        # callers modify the ingress they get, so don't hand out the
+        # cached one
+        return copy.deepcopy(ingress)
 
-    if ingress is None:
+    if ingresses_synced.is_set():
         raise IngressNotFound(hostname)
 
-    return ingress
+    # the watch hasn't listed the ingresses yet, so fall back to listing.
+    # resource_version '0' lets the API server answer from its watch cache
+    # instead of a quorum read from etcd
+    listed = extensions_api.list_ingress_for_all_namespaces(
+        resource_version='0')
+    for ingress in listed.items:
+        if (ingress.metadata.name != UNIDLER and
+                hostname in ingress_rule_hosts(ingress)):
+            cache_ingress(ingress)
+            return copy.deepcopy(ingress)
+
+    raise IngressNotFound(hostname)
+
+
+def watch_ingresses():
+    keep_cached(
+        'Ingress',
+        extensions_api.list_ingress_for_all_namespaces,
+        ingresses,
+        cache_ingress,
+        uncache_ingress,
+        ingresses_synced)
+
+
+def watch_deployments():
+    keep_cached(
+        'Deployment',
+        apps_api.list_deployment_for_all_namespaces,
+        deployments,
+        cache_deployment,
+        uncache_deployment)
+
+
+def keep_cached(kind, list_all, cached, cache, uncache, synced=None):
+    # each Watch builds its own ApiClient (and thread pool) to decode
+    # events, so reuse one across restarts
+    watcher = watch.Watch()
+    retry_seconds = WATCH_RETRY_SECONDS
+    resource_version = None
+    while True:
+        try:
+            if resource_version is None:
+                resource_version = sync_cache(
+                    list_all, cached, cache, uncache)
+                retry_seconds = WATCH_RETRY_SECONDS
+                if synced is not None:
+                    synced.set()
+
+            # the watch reconnects from its own resource version rather than
+            # the one passed in, which is still from the previous round
+            watcher.resource_version = resource_version
+            for event in watcher.stream(
+                    list_all,
+                    resource_version=resource_version,
+                    timeout_seconds=WATCH_TIMEOUT_SECONDS,
+                    _request_timeout=WATCH_READ_TIMEOUT_SECONDS):
+                if event['type'] == 'ERROR':
+                    # usually 410 Gone once our resource version is too
+                    # old, so start again from a fresh list
+                    app_log.warning('%s watch error: %s', kind, event['raw_object'])
+                    resource_version = None
+                    break
+
+                elif event['type'] == 'DELETED':
+                    uncache(object_key(event['object']))
+
+                else:
+                    cache(event['object'])
+
+            else:
+                # timed out as asked, so carry on from the last event
+                # without listing again
+                resource_version = watcher.resource_version
+
+        except Exception as error:
+            app_log.error('%s watch failed: %s', kind, error)
+            resource_version = None
+            time.sleep(retry_seconds)
+            retry_seconds = min(retry_seconds * 2, WATCH_RETRY_MAX_SECONDS)
+
+
+def sync_cache(list_all, cached, cache, uncache):
+    keys = set()
+    for page in list_pages(list_all):
+        for obj in page.items:
+            cache(obj)
+            keys.add(object_key(obj))
+        resource_version = page.metadata.resource_version
+
+    for key in set(cached) - keys:
+        uncache(key)
+
+    return resource_version
+
+
+def list_pages(list_all):
+    # the API server ignores limit for resource_version '0' lists, so
+    # paging means a consistent read. That's worth it here, where the
+    # list can be the whole cluster and is only made when (re)starting
+    # a watch
+    kwargs = {'limit': LIST_PAGE_SIZE}
+    while True:
+        page = list_all(**kwargs)
+        yield page
+
+        if not page.metadata._continue:
+            return
+        kwargs['_continue'] = page.metadata._continue
+
+
+def object_key(obj):
+    return (obj.metadata.name, obj.metadata.namespace)
+
+
+def cache_deployment(deployment):
+    deployments[object_key(deployment)] = deployment
+
+
+def uncache_deployment(key):
+    deployments.pop(key, None)
+
+
+def cache_ingress(ingress):
+    key = object_key(ingress)
+    old = ingresses.get(key)
+    ingresses[key] = ingress
+
+    # the unidler ingress has rules for every idled host, but isn't the
+    # one serving them
+    hosts = set()
+    if ingress.metadata.name != UNIDLER:
+        hosts.update(ingress_rule_hosts(ingress))
+        for hostname in hosts:
+            ingress_hosts[hostname] = key
+
+    # only then unindex the hosts the old version had but this one
+    # doesn't, so lookups running meanwhile never miss a host
+    if old is not None:
+        for hostname in ingress_rule_hosts(old):
+            if hostname not in hosts and ingress_hosts.get(hostname) == key:
+                del ingress_hosts[hostname]
+
+
+def uncache_ingress(key):
+    ingress = ingresses.pop(key, None)
+    if ingress is None:
+        return
+
+    for hostname in ingress_rule_hosts(ingress):
+        if ingress_hosts.get(hostname) == key:
+            del ingress_hosts[hostname]
+
+
+def ingress_rule_hosts(ingress):
+    return [rule.host for rule in ingress.spec.rules or [] if rule.host]
 
 
 def is_idle(hostname, log=app_log):
-    deployment = deployment_for_ingress(ingress_for_host(hostname))
-    log.debug('Is idle?  "idled" label = {}'.format(IDLED in deployment.metadata.labels))
+    ingress = ingress_for_host(hostname)
+    # the idler's annotation on the ingress is enough to know, without
+    # looking up the deployment
+    if IDLED_AT in ingress.metadata.annotations:
+        log.debug('Is idle?  ingress has idled-at annotation')
+        return True
+
+    deployment = deployment_for_ingress(ingress, cached=True)
+    log.debug('Is idle?  "idled" label = %s', IDLED in deployment.metadata.labels)
     return IDLED in deployment.metadata.labels
 
 
-def restore_replicas(deployment, log=app_log):
-    annotation = deployment.metadata.annotations.get(IDLED_AT)
-
+def idled_replicas(annotation, log=app_log):
     if annotation is not None:
-        replicas = annotation.split(',')[1]
+        # idled-at annotation is "<timestamp>,<replicas>"
+        replicas = int(annotation.split(',')[1])
     else:
         log.error('Deployment has no idled-at annotation - assuming 1 replica')
         replicas = 1
 
-    log.debug(f'Restoring {replicas} replicas')
-    deployment.spec.replicas = int(replicas)
-
-def unmark_idled(deployment, log=app_log):
-    log.debug('Removing idled annotation and label')
-    if IDLED in deployment.metadata.labels:
-        del deployment.metadata.labels[IDLED]
-    if IDLED_AT in deployment.metadata.annotations:
-        del deployment.metadata.annotations[IDLED_AT]
+    log.debug('Restoring %s replicas', replicas)
+    return replicas
 
 
-def write_deployment_changes(deployment, log=app_log):
+def write_deployment_changes(name, namespace, replicas, log=app_log):
     log.debug(
-        f'Writing changes to deployment {deployment.metadata.name} '
-        f'in namespace {deployment.metadata.namespace}')
-    client.AppsV1beta1Api().replace_namespaced_deployment(
-        deployment.metadata.name,
-        deployment.metadata.namespace,
-        deployment)
+        'Writing changes to deployment %s in namespace %s', name, namespace)
+    # restore the replicas and remove the idled label and annotation in
+    # one patch, without first reading and modifying the deployment
+    try:
+        return apps_api.patch_namespaced_deployment(
+            name,
+            namespace,
+            {
+                'metadata': {
+                    'labels': {IDLED: None},
+                    'annotations': {IDLED_AT: None},
+                },
+                'spec': {
+                    'replicas': replicas,
+                },
+            })
+
+    except kubernetes.client.rest.ApiException as error:
+        if error.status == HTTPStatus.NOT_FOUND:
+            raise DeploymentNotFound(name, namespace)
+        raise
 
 
 def write_ingress_changes(ingress, log=app_log):
     log.debug(
-        f'Writing changes to ingress {ingress.metadata.name} '
-        f'in namespace {ingress.metadata.namespace}')
-    client.ExtensionsV1beta1Api().patch_namespaced_ingress(
+        'Writing changes to ingress %s in namespace %s',
+        ingress.metadata.name, ingress.metadata.namespace)
+    # only send the fields the unidler changes, rather than the whole
+    # ingress
+    patched = extensions_api.patch_namespaced_ingress(
         ingress.metadata.name,
         ingress.metadata.namespace,
-        ingress)
+        ingress_changes(ingress))
+    # don't wait for the watch, so lookups don't see the ingress from
+    # before the write
+    cache_ingress(patched)
+
+
+def ingress_changes(ingress):
+    return {
+        'metadata': {
+            # an idled-at annotation no longer on the ingress is removed
+            'annotations': {
+                IDLED_AT: None,
+                **(ingress.metadata.annotations or {}),
+            },
+        },
+        'spec': {
+            'rules': ingress.spec.rules,
+            'tls': ingress.spec.tls,
+        },
+    }
 
 
 def unidler_ingress():
-    return client.ExtensionsV1beta1Api().read_namespaced_ingress(
+    return extensions_api.read_namespaced_ingress(
         UNIDLER, UNIDLER_NAMESPACE)
 
 
 def remove_host_rule(hostname, ingress, log=app_log):
     log.debug(
-        f'Removing host rules for {hostname} '
-        f'from ingress {ingress.metadata.name} '
-        f'in namespace {ingress.metadata.namespace}')
+        'Removing host rules for %s from ingress %s in namespace %s',
+        hostname, ingress.metadata.name, ingress.metadata.namespace)
+
+    rules = [rule for rule in ingress.spec.rules if rule.host != hostname]
+    removed = len(ingress.spec.rules) - len(rules)
+    ingress.spec.rules = rules
+
+    for tls in ingress.spec.tls or []:
+        hosts = [host for host in tls.hosts or [] if host != hostname]
+        removed += len(tls.hosts or []) - len(hosts)
+        tls.hosts = hosts
 
-    num_rules_before = len(ingress.spec.rules)
-    ingress.spec.rules = list(
-        filter(
-            lambda rule: rule.host != hostname,
-            ingress.spec.rules))
-    log.debug('Rules removed: {}'.format(num_rules_before - len(ingress.spec.rules)))
+    log.debug('Rules removed: %s', removed)
+    return removed
 
 
 def enable_ingress(ingress):
     ingress.metadata.annotations[INGRESS_CLASS] = INGRESS_CLASS_NAME
+    ingress.metadata.annotations.pop(IDLED_AT, None)
+
+
+# only a handful of statuses are ever sent
+@functools.lru_cache(maxsize=None)
+def response_head(protocol_version, status):
+    return (
+        f'{protocol_version} {status.value} {status.phrase}\r\n'
+        'Content-type: text/html\r\n'
+    ).encode('latin-1')
 
 
+# browsers poll the same few hosts while they unidle, so keep their
+# finished pages. Only a few, as each is a copy of the whole page
+@functools.lru_cache(maxsize=16)
 def please_wait(hostname):
-    with open('please_wait.html') as f:
-        body = f.read()
-        return body.replace(
-            f"UNIDLER_REDIRECT_URL = ''",
-            f"UNIDLER_REDIRECT_URL = 'https://{hostname}'")
+    return b''.join((
+        PLEASE_WAIT_HEAD,
+        f"UNIDLER_REDIRECT_URL = 'https://{hostname}'".encode('utf-8'),
+        PLEASE_WAIT_TAIL,
+    ))
 
 
 if __name__ == '__main__':